@@ -1,5 +1,9 @@
 import sqlite3
 import datetime
+import hashlib
+import html
+import os
+import threading
 from traceback import print_exc
 from logger import get_logger
 
@@ -7,12 +11,97 @@ logger = get_logger(__name__)
 
 RSS_DB_PATH = "rss_feed.db"
 
-def get_rss_db_connection():
-    """Get connection to RSS database"""
-    conn = sqlite3.connect(RSS_DB_PATH)
+# Hot statements are kept as module constants and run with conn.execute, so every call passes
+# the same SQL text and hits the connection's prepared statement cache instead of re-preparing it
+INSERT_SQL = """
+    INSERT OR IGNORE INTO rss_items (title, content, content_html, url, url_hash, published_date)
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
+
+SELECT_SQL = """
+    SELECT title, content_html, url, published_date
+    FROM rss_items
+    ORDER BY published_date DESC, id DESC
+    LIMIT ?
+"""
+
+# Deletes everything older than the newest max_items items in one statement.
+# The threshold is read through idx_published_date_id; if there are fewer than
+# max_items items the subquery yields NULL and nothing is deleted.
+DELETE_SQL = """
+    DELETE FROM rss_items
+    WHERE published_date < (
+        SELECT published_date FROM rss_items
+        ORDER BY published_date DESC, id DESC
+        LIMIT 1 OFFSET ?
+    )
+"""
+
+FEED_STATE_SQL = "SELECT MAX(id), COUNT(*) FROM rss_items"
+
+COUNT_SQL = "SELECT COUNT(*) FROM rss_items"
+
+RECENT_URLS_SQL = "SELECT url FROM rss_items ORDER BY id DESC LIMIT ?"
+
+# Set once init_rss_db has created or migrated the database in this process
+_initialized = False
+
+# journal_mode=WAL is persisted in the database file, so it only needs to be set once per process
+_wal_enabled = False
+
+# One persistent connection per thread, so the page cache and statement cache survive between calls
+_tls = threading.local()
+
+def to_unix_us(dt):
+    """Convert an aware datetime to the integer microseconds since the epoch stored in published_date"""
+    return int(dt.timestamp() * 1_000_000)
+
+def url_hash(url):
+    """Get a 63-bit hash of url, so duplicate checks compare 8-byte integers instead of long URLs"""
+    digest = hashlib.blake2b(url.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") & 0x7FFFFFFFFFFFFFFF
+
+def get_rss_db_connection(readonly=False):
+    """
+    Get the calling thread's connection to the RSS database, opening it on first use.
+
+    Readers (the feed server threads) use a separate read-only connection so they never take write locks.
+    """
+    attr = "ro_conn" if readonly else "conn"
+    conn, pid = getattr(_tls, attr, (None, None))
+    # A connection inherited from the parent process must not be reused after fork
+    if conn is not None and pid == os.getpid():
+        return conn
+    conn = _open_rss_db_connection(readonly)
+    setattr(_tls, attr, (conn, os.getpid()))
+    return conn
+
+def _open_rss_db_connection(readonly=False):
+    """Open a new connection to the RSS database with the tuned PRAGMAs applied"""
+    global _wal_enabled
+    if readonly:
+        conn = sqlite3.connect(f"file:{RSS_DB_PATH}?mode=ro", uri=True, check_same_thread=False)
+    else:
+        conn = sqlite3.connect(RSS_DB_PATH, check_same_thread=False)
+        if not _wal_enabled:
+            conn.execute("PRAGMA journal_mode = WAL")
+            _wal_enabled = True
+    # WAL lets readers proceed while the queue thread is writing and needs one fsync less per commit
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    conn.execute("PRAGMA cache_size = -64000")
+    conn.execute("PRAGMA busy_timeout = 30000")
     conn.execute("PRAGMA foreign_keys = ON")
     return conn
 
+def init_rss_db():
+    """Create or migrate the RSS database once per process"""
+    global _initialized
+    if _initialized:
+        return
+    create_rss_db()
+    _initialized = True
+
 def create_rss_db():
     """Create RSS database and tables if they don't exist"""
     conn = None
@@ -26,16 +115,49 @@ def create_rss_db():
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 title TEXT NOT NULL,
                 content TEXT NOT NULL,
-                url TEXT NOT NULL UNIQUE,
-                published_date TIMESTAMP NOT NULL,
+                content_html TEXT,
+                url TEXT NOT NULL,
+                url_hash INTEGER,
+                published_date INTEGER NOT NULL,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         """)
 
-        # Create index on published_date for faster sorting
+        # Databases created before content_html existed get the column added and backfilled
+        columns = [row[1] for row in cursor.execute("PRAGMA table_info(rss_items)")]
+        if "content_html" not in columns:
+            cursor.execute("ALTER TABLE rss_items ADD COLUMN content_html TEXT")
+            rows = cursor.execute("SELECT id, content FROM rss_items").fetchall()
+            cursor.executemany("UPDATE rss_items SET content_html = ? WHERE id = ?",
+                               [(html.escape(content), id) for id, content in rows])
+
+        # Older databases deduplicate on the url column itself; give them the hash column as well
+        if "url_hash" not in columns:
+            cursor.execute("ALTER TABLE rss_items ADD COLUMN url_hash INTEGER")
+            rows = cursor.execute("SELECT id, url FROM rss_items").fetchall()
+            cursor.executemany("UPDATE rss_items SET url_hash = ? WHERE id = ?",
+                               [(url_hash(url), id) for id, url in rows])
+
+        # published_date used to be stored as ISO 8601 text; convert it to integer microseconds
+        rows = cursor.execute(
+            "SELECT id, published_date FROM rss_items WHERE typeof(published_date) = 'text'").fetchall()
+        if rows:
+            cursor.executemany("UPDATE rss_items SET published_date = ? WHERE id = ?",
+                               [(to_unix_us(datetime.datetime.fromisoformat(published_date.replace('Z', '+00:00'))), id)
+                                for id, published_date in rows])
+
+        # Duplicate URLs are rejected through the hash
+        cursor.execute("""
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_url_hash
+            ON rss_items(url_hash)
+        """)
+
+        # Create index on published_date for faster sorting. Items drained together share a
+        # published_date, so id breaks ties; the index covers both to avoid a sort step.
+        cursor.execute("DROP INDEX IF EXISTS idx_published_date")
         cursor.execute("""
-            CREATE INDEX IF NOT EXISTS idx_published_date
-            ON rss_items(published_date DESC)
+            CREATE INDEX IF NOT EXISTS idx_published_date_id
+            ON rss_items(published_date DESC, id DESC)
         """)
 
         conn.commit()
@@ -43,9 +165,8 @@ def create_rss_db():
 
     except Exception as e:
         logger.error(f"Error creating RSS database: {str(e)}", exc_info=True)
-    finally:
         if conn:
-            conn.close()
+            conn.rollback()
 
 def add_rss_item(title, content, url, published_date=None):
     """Add new RSS item to database"""
@@ -55,16 +176,14 @@ def add_rss_item(title, content, url, published_date=None):
             published_date = datetime.datetime.now(datetime.timezone.utc)
 
         conn = get_rss_db_connection()
-        cursor = conn.cursor()
 
         # Insert item (IGNORE duplicate URLs)
-        cursor.execute("""
-            INSERT OR IGNORE INTO rss_items (title, content, url, published_date)
-            VALUES (?, ?, ?, ?)
-        """, (title, content, url, published_date))
+        cursor = conn.execute(INSERT_SQL, (title, content, html.escape(content), url, url_hash(url),
+                                           to_unix_us(published_date)))
+        # Always commit: the connection is reused, so an open transaction would keep the write lock
+        conn.commit()
 
         if cursor.rowcount > 0:
-            conn.commit()
             logger.debug(f"Added RSS item: {title}")
             return True
         else:
@@ -73,80 +192,121 @@ def add_rss_item(title, content, url, published_date=None):
 
     except Exception as e:
         logger.error(f"Error adding RSS item: {str(e)}", exc_info=True)
-        return False
-    finally:
         if conn:
-            conn.close()
+            conn.rollback()
+        return False
 
-def get_rss_items(limit=100):
-    """Get RSS items from database, ordered by published_date DESC"""
+def add_rss_items_bulk(rows):
+    """
+    Add a batch of (title, content, url, published_date datetime) rows in a single transaction.
+
+    Returns the number of rows inserted, or None if the batch could not be written.
+    """
     conn = None
     try:
         conn = get_rss_db_connection()
-        cursor = conn.cursor()
+        # Take the write lock up front so the whole batch costs one commit
+        conn.execute("BEGIN IMMEDIATE")
+        with conn:
+            # Escape once at insert time so rendering the feed can use content_html as is
+            cursor = conn.executemany(INSERT_SQL, [
+                (title, content, html.escape(content), url, url_hash(url), to_unix_us(published_date))
+                for title, content, url, published_date in rows])
 
-        cursor.execute("""
-            SELECT title, content, url, published_date
-            FROM rss_items
-            ORDER BY published_date DESC
-            LIMIT ?
-        """, (limit,))
+        logger.debug(f"Added {cursor.rowcount} of {len(rows)} RSS items")
+        return cursor.rowcount
 
-        return cursor.fetchall()
+    except Exception as e:
+        logger.error(f"Error adding RSS items: {str(e)}", exc_info=True)
+        if conn and conn.in_transaction:
+            conn.rollback()
+        return None
+
+def iter_rss_items(limit=100):
+    """
+    Get an iterator over RSS items (title, content_html, url, published_date) from database,
+    ordered by published_date DESC.
+
+    The query runs and the first batch is fetched before returning, so database errors are raised
+    here rather than once iteration has started. The remaining rows are fetched in small batches
+    so the caller can start using them before the query is done.
+    published_date is in microseconds since the epoch.
+    """
+    conn = get_rss_db_connection(readonly=True)
+    cursor = conn.execute(SELECT_SQL, (limit,))
+    try:
+        rows = cursor.fetchmany(64)
+    except Exception:
+        cursor.close()
+        raise
+    return _iter_rows(cursor, rows)
 
+def _iter_rows(cursor, rows):
+    """Yield rows, then the rest of cursor in batches of 64"""
+    try:
+        while rows:
+            yield from rows
+            rows = cursor.fetchmany(64)
+    finally:
+        # Ends the read transaction even if the consumer stops early
+        cursor.close()
+
+def get_rss_items(limit=100):
+    """Get RSS items from database as a list, see iter_rss_items"""
+    try:
+        return list(iter_rss_items(limit))
     except Exception as e:
         logger.error(f"Error getting RSS items: {str(e)}", exc_info=True)
         return []
-    finally:
-        if conn:
-            conn.close()
 
 def cleanup_old_rss_items(max_items=1000):
     """Remove old RSS items beyond max_items limit"""
     conn = None
     try:
         conn = get_rss_db_connection()
-        cursor = conn.cursor()
+        cursor = conn.execute(DELETE_SQL, (max_items - 1,))
+        conn.commit()
 
-        # Count total items
-        cursor.execute("SELECT COUNT(*) FROM rss_items")
-        total_items = cursor.fetchone()[0]
-
-        if total_items > max_items:
-            # Delete oldest items beyond the limit
-            items_to_delete = total_items - max_items
-            cursor.execute("""
-                DELETE FROM rss_items
-                WHERE id IN (
-                    SELECT id FROM rss_items
-                    ORDER BY published_date ASC
-                    LIMIT ?
-                )
-            """, (items_to_delete,))
-
-            conn.commit()
+        if cursor.rowcount > 0:
             logger.info(f"Cleaned up {cursor.rowcount} old RSS items")
 
     except Exception as e:
         logger.error(f"Error cleaning up RSS items: {str(e)}", exc_info=True)
-    finally:
         if conn:
-            conn.close()
+            conn.rollback()
+
+def optimize_rss_db():
+    """Refresh query planner statistics and checkpoint the WAL so it does not grow unbounded"""
+    try:
+        conn = get_rss_db_connection()
+        conn.execute("PRAGMA optimize")
+        conn.execute("PRAGMA wal_checkpoint(PASSIVE)")
+    except Exception as e:
+        logger.error(f"Error optimizing RSS database: {str(e)}", exc_info=True)
+
+def get_rss_feed_state():
+    """Get (max id, item count), which changes whenever the feed content does"""
+    try:
+        conn = get_rss_db_connection(readonly=True)
+        return conn.execute(FEED_STATE_SQL).fetchone()
+    except Exception as e:
+        logger.error(f"Error getting RSS feed state: {str(e)}", exc_info=True)
+        return None, 0
+
+def get_recent_rss_urls(limit=10000):
+    """Get the URLs of the most recently added RSS items, newest first"""
+    try:
+        conn = get_rss_db_connection(readonly=True)
+        return [row[0] for row in conn.execute(RECENT_URLS_SQL, (limit,))]
+    except Exception as e:
+        logger.error(f"Error getting recent RSS URLs: {str(e)}", exc_info=True)
+        return []
 
 def get_rss_items_count():
     """Get total count of RSS items"""
-    conn = None
     try:
-        conn = get_rss_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM rss_items")
-        return cursor.fetchone()[0]
+        conn = get_rss_db_connection(readonly=True)
+        return conn.execute(COUNT_SQL).fetchone()[0]
     except Exception as e:
         logger.error(f"Error getting RSS items count: {str(e)}", exc_info=True)
         return 0
-    finally:
-        if conn:
-            conn.close()
-
-# Initialize database on module import
-create_rss_db()
\ No newline at end of file
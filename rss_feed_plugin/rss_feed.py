@@ -1,31 +1,125 @@
-from flask import Flask, Response, request
-import threading, time, db, datetime, html
-from queue import Empty as QueueEmpty
+from flask import Flask, Response, request, stream_with_context
+from waitress import serve
+import threading, time, db, datetime, hashlib, collections, gzip
+from email.utils import format_datetime
+from queue import Queue, Empty as QueueEmpty
+from xml.sax.saxutils import escape
 from logger import get_logger
-from feedgen.feed import FeedGenerator
 
 # Import RSS database functions
 try:
-    from .rss_db import add_rss_item, get_rss_items, cleanup_old_rss_items
+    from .rss_db import init_rss_db, add_rss_items_bulk, iter_rss_items, get_rss_feed_state, get_recent_rss_urls, cleanup_old_rss_items, optimize_rss_db
 except ImportError:
     # Fallback for when running as main module
-    from rss_feed_plugin.rss_db import add_rss_item, get_rss_items, cleanup_old_rss_items
+    from rss_feed_plugin.rss_db import init_rss_db, add_rss_items_bulk, iter_rss_items, get_rss_feed_state, get_recent_rss_urls, cleanup_old_rss_items, optimize_rss_db
 
 # Get logger for this module
 logger = get_logger(__name__)
 
+# Title line prefix in configuration_values.MESSAGE
+TITLE_MARKER = '🆕 Title : '
+DEFAULT_TITLE = "New Vinted Item"
+
+# The writer thread commits whatever it collected after WRITE_BATCH_SECONDS or WRITE_BATCH_ROWS rows
+WRITE_BATCH_SECONDS = 0.05
+WRITE_BATCH_ROWS = 500
+WRITE_QUEUE_SIZE = 1000
+
+# Number of recently seen URLs remembered to drop duplicates before they reach the database
+RECENT_URLS_SIZE = 10_000
+
+FEED_TITLE = 'Vinted Notifications'
+FEED_DESCRIPTION = 'Latest items from Vinted matching your search queries'
+
+# rss_max_items is read at most once per MAX_ITEMS_TTL seconds, stored as (expires_at, value)
+MAX_ITEMS_TTL = 60
+_max_items_cache = (None, 100)
+
+
+def _cached_max_items():
+    """Get the rss_max_items parameter, re-reading it from the database once the cached value expires"""
+    global _max_items_cache
+    now = time.monotonic()
+    expires_at, max_items = _max_items_cache
+    if expires_at is not None and now < expires_at:
+        return max_items
+    try:
+        max_items = int(db.get_parameter("rss_max_items"))
+    except Exception:
+        max_items = 100
+    _max_items_cache = (now + MAX_ITEMS_TTL, max_items)
+    return max_items
+
+
+def _published_datetime(published_us):
+    """Convert a published_date in microseconds since the epoch to an aware UTC datetime"""
+    return datetime.datetime.fromtimestamp(published_us / 1_000_000, tz=datetime.timezone.utc)
+
+
+def _render_rss(host_url, items, description=FEED_DESCRIPTION):
+    """
+    Render an RSS 2.0 document.
+
+    The schema is fixed, so the XML is written directly instead of building a tree.
+    The document is yielded piece by piece so it can be streamed while items are still being read.
+
+    Args:
+        host_url (str): The host URL seen by the client, used as the channel link
+        items (iterable): (title, content_html, url, published_date) rows
+        description (str): The channel description
+
+    Yields:
+        bytes: UTF-8 encoded chunks of the feed
+    """
+    yield ("<?xml version='1.0' encoding='UTF-8'?>\n"
+           '<rss xmlns:atom="http://www.w3.org/2005/Atom" '
+           'xmlns:content="http://purl.org/rss/1.0/modules/content/" version="2.0"><channel>'
+           f"<title>{escape(FEED_TITLE)}</title>"
+           f"<link>{escape(host_url.rstrip('/'))}</link>"
+           f"<description>{escape(description)}</description>"
+           "<docs>http://www.rssboard.org/rss-specification</docs>"
+           "<language>en</language>"
+           f"<lastBuildDate>{format_datetime(datetime.datetime.now(datetime.timezone.utc))}</lastBuildDate>"
+           ).encode('utf-8')
+    for title, content_html, url, published_date in items:
+        url = escape(url)
+        yield (f"<item><title>{escape(title)}</title>"
+               f"<link>{url}</link>"
+               f"<description>{escape(content_html)}</description>"
+               f'<guid isPermaLink="false">{url}</guid>'
+               f"<pubDate>{format_datetime(_published_datetime(published_date))}</pubDate></item>"
+               ).encode('utf-8')
+    yield b"</channel></rss>"
+
 
 class RSSFeed:
     def __init__(self, queue):
         self.app = Flask(__name__)
         self.queue = queue
-        # Do not cache max_items; fetch from DB when needed
+        # Create or migrate the database before any reader or writer thread starts
+        init_rss_db()
+        # max_items is read through _cached_max_items, so config changes apply within MAX_ITEMS_TTL
 
-        # RSS feed will be generated dynamically from database
+        # RSS feed will be generated dynamically from database.
+        # The last rendered feed is kept as (key, xml) and reused while the key still matches.
+        self._cache = (None, None)
+        # Gzip-compressed copy of the cached feed, as (key, gzipped xml)
+        self._gzip_cache = (None, None)
+
+        # URLs known to be in the database, oldest first, mirrored in a set for O(1) lookups.
+        # Only the writer thread updates them once the database holds the items.
+        self.load_recent_urls()
 
         # Set up routes
         self.app.route('/')(self.serve_rss)
 
+        # All writes go through a single writer thread owning the read-write connection, so writers
+        # never contend for the lock. It takes lists of rows to insert and callables to run.
+        self._write_q = Queue(maxsize=WRITE_QUEUE_SIZE)
+        self.writer_thread = threading.Thread(target=self._writer_loop)
+        self.writer_thread.daemon = True
+        self.writer_thread.start()
+
         # Start thread to check queue
         self.thread = threading.Thread(target=self.run_check_queue)
         self.thread.daemon = True
@@ -39,116 +133,183 @@ class RSSFeed:
     def run_check_queue(self):
         while True:
             try:
-                # Drain the queue without relying on Queue.empty(), which is unreliable
-                processed = 0
+                # Block until an item arrives instead of polling, so an idle thread does not wake up
+                try:
+                    items = [self.queue.get(timeout=1.0)]
+                except QueueEmpty:
+                    continue
+                # Drain the rest of the queue without relying on Queue.empty(), which is unreliable
                 while True:
                     try:
-                        content, url, text, buy_url, buy_text = self.queue.get_nowait()
-                        self.add_item_to_feed(content, url)
-                        processed += 1
+                        items.append(self.queue.get_nowait())
                     except QueueEmpty:
                         break
                     except Exception as e:
                         logger.error(f"Error getting item from RSS queue: {str(e)}", exc_info=True)
                         break
-                if processed == 0:
-                    time.sleep(0.1)  # Small sleep to prevent high CPU usage when idle
+                rows = self.build_rows(items)
+                if rows:
+                    self._write_q.put(rows)
             except Exception as e:
                 logger.error(f"Error checking RSS queue: {str(e)}", exc_info=True)
 
+    def _writer_loop(self):
+        """Apply queued writes, inserting the rows collected within a short window in one transaction"""
+        while True:
+            try:
+                rows = []
+                tasks = []
+                task = self._write_q.get()
+                deadline = time.monotonic() + WRITE_BATCH_SECONDS
+                while True:
+                    if callable(task):
+                        tasks.append(task)
+                    else:
+                        rows.extend(task)
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or len(rows) >= WRITE_BATCH_ROWS:
+                        break
+                    try:
+                        task = self._write_q.get(timeout=remaining)
+                    except QueueEmpty:
+                        break
+                # Remember URLs only once they are committed, so a failed insert can be retried
+                if rows and add_rss_items_bulk(rows) is not None:
+                    for title, content, url, published_date in rows:
+                        self.remember_url(url)
+                for task in tasks:
+                    task()
+            except Exception as e:
+                logger.error(f"Error writing to RSS database: {str(e)}", exc_info=True)
+
     def periodic_cleanup(self):
         """Periodically clean up old RSS items"""
         while True:
             try:
                 time.sleep(3600)  # Run cleanup every hour
-                # Re-read max_items from DB to honor config changes without restart
-                try:
-                    max_items = int(db.get_parameter("rss_max_items"))
-                except Exception:
-                    max_items = 100
-                cleanup_old_rss_items(max_items * 10)  # Keep 10x max for buffer
+                # max_items comes from _cached_max_items, so config changes apply without restart
+                # but the value may be up to MAX_ITEMS_TTL seconds old
+                max_items = _cached_max_items()
+
+                def cleanup():
+                    cleanup_old_rss_items(max_items * 10)  # Keep 10x max for buffer
+                    # Forget deleted URLs so items that come back are added again
+                    self.load_recent_urls()
+                    optimize_rss_db()
+
+                self._write_q.put(cleanup)
             except Exception as e:
                 logger.error(f"Error in periodic cleanup: {str(e)}", exc_info=True)
 
     def check_rss_queue(self):
         # Deprecated by run_check_queue drain logic; keep for backward compatibility
+        items = []
         try:
             while True:
-                content, url, text, buy_url, buy_text = self.queue.get_nowait()
-                self.add_item_to_feed(content, url)
+                items.append(self.queue.get_nowait())
         except QueueEmpty:
-            return
+            pass
         except Exception as e:
             logger.error(f"Error processing item for RSS feed: {str(e)}", exc_info=True)
+        rows = self.build_rows(items)
+        if rows:
+            self._write_q.put(rows)
 
-    def add_item_to_feed(self, content, url):
+    @staticmethod
+    def extract_title(content):
         # Extract title from content (assuming it's in the format from configuration_values.MESSAGE)
-        title = "New Vinted Item"
-        try:
-            # Try to extract title from the content
-            title_start = content.find('🆕 Title : ') + len('🆕 Title : ')
-            if title_start > len('🆕 Title : '):
-                title_end = content.find('\n', title_start)
-                if title_end > 0:
-                    title = content[title_start:title_end]
-        except:
-            pass
+        _, sep, rest = content.partition(TITLE_MARKER)
+        return rest.partition('\n')[0] if sep else DEFAULT_TITLE
+
+    def load_recent_urls(self):
+        """Reload the recently seen URLs from the items currently in the database"""
+        recent_urls = collections.deque(reversed(get_recent_rss_urls(RECENT_URLS_SIZE)), maxlen=RECENT_URLS_SIZE)
+        self._recent_urls = recent_urls
+        self._recent_url_set = set(recent_urls)
 
-        # Add item to RSS database
-        published_date = datetime.datetime.now(datetime.timezone.utc)
-        success = add_rss_item(title, content, url, published_date)
+    def remember_url(self, url):
+        """Record url as seen, forgetting the oldest one once RECENT_URLS_SIZE is reached"""
+        # A URL held twice in the deque would be dropped from the set when its older copy is evicted
+        if url in self._recent_url_set:
+            return
+        if len(self._recent_urls) == self._recent_urls.maxlen:
+            self._recent_url_set.discard(self._recent_urls[0])
+        self._recent_urls.append(url)
+        self._recent_url_set.add(url)
 
-        if success:
-            logger.debug(f"Added RSS item to database: {title}")
-        else:
-            logger.debug(f"RSS item already exists in database: {url}")
+    def build_rows(self, items):
+        """Turn drained queue items into rss_items rows sharing a single published_date"""
+        # Items drained together arrived within microseconds, so one timestamp covers the batch
+        now = datetime.datetime.now(datetime.timezone.utc)
+        rows = []
+        batch_urls = set()
+        for content, url, text, buy_url, buy_text in items:
+            # Reposted items are dropped here instead of costing an INSERT OR IGNORE
+            if url in self._recent_url_set or url in batch_urls:
+                continue
+            batch_urls.add(url)
+            rows.append((self.extract_title(content), content, url, now))
+        return rows
 
     def serve_rss(self):
         """Generate RSS feed dynamically from database"""
         try:
-            # Create fresh feed generator
-            fg = FeedGenerator()
-            fg.title('Vinted Notifications')
-            fg.description('Latest items from Vinted matching your search queries')
-            # Use the actual host seen by the client instead of localhost
-            fg.link(href=request.host_url.rstrip('/'))
-            fg.language('en')
-
-            # Get items from database
-            try:
-                max_items = int(db.get_parameter("rss_max_items"))
-            except Exception:
-                max_items = 100
-            items = get_rss_items(limit=max_items)
-
-            # Add each item to the feed
-            for title, content, url, published_date in items:
-                fe = fg.add_entry()
-                fe.id(url)
-                fe.title(title)
-                fe.link(href=url)
-                fe.description(html.escape(content))
-
-                # Parse published_date if it's a string
-                if isinstance(published_date, str):
-                    try:
-                        published_date = datetime.datetime.fromisoformat(published_date.replace('Z', '+00:00'))
-                    except:
-                        published_date = datetime.datetime.now(datetime.timezone.utc)
+            max_items = _cached_max_items()
 
-                fe.published(published_date)
+            # Serve the cached feed if no item was added or removed since it was rendered
+            max_id, count = get_rss_feed_state()
+            key = (request.host_url, max_items, max_id, count)
+            etag = hashlib.sha1(repr(key).encode()).hexdigest()
+            cached_key, xml = self._cache
 
-            return Response(fg.rss_str(), mimetype='application/rss+xml')
+            if 'gzip' in request.headers.get('Accept-Encoding', ''):
+                # Compress once per feed version and reuse the result for every later request
+                gzip_key, body = self._gzip_cache
+                if gzip_key != key:
+                    if cached_key != key:
+                        xml = b"".join(_render_rss(request.host_url, iter_rss_items(max_items)))
+                        self._cache = (key, xml)
+                    body = gzip.compress(xml, compresslevel=6)
+                    self._gzip_cache = (key, body)
+                response = Response(body, mimetype='application/rss+xml')
+                response.content_encoding = 'gzip'
+                etag += '-gzip'
+            elif cached_key == key:
+                response = Response(xml, mimetype='application/rss+xml')
+            else:
+                # The query runs here, so a failing database still gets the error feed below
+                items = iter_rss_items(max_items)
+                response = Response(stream_with_context(self.stream_feed(key, request.host_url, items)),
+                                    mimetype='application/rss+xml')
+                # A stream can still be cut short after the headers are sent, so it carries
+                # no ETag; clients get one from the cached copy on their next poll
+                etag = None
+
+            response.vary.add('Accept-Encoding')
+            # No Last-Modified: the body also depends on max_items and the host, which a date
+            # cannot express, so conditional requests are answered from the ETag only
+            if etag is not None:
+                response.set_etag(etag)
+            return response.make_conditional(request)
 
         except Exception as e:
             logger.error(f"Error generating RSS feed: {str(e)}", exc_info=True)
             # Return empty feed on error
-            fg = FeedGenerator()
-            fg.title('Vinted Notifications')
-            fg.description('Error generating feed')
-            fg.link(href=request.host_url.rstrip('/'))
-            fg.language('en')
-            return Response(fg.rss_str(), mimetype='application/rss+xml')
+            return Response(_render_rss(request.host_url, [], 'Error generating feed'),
+                            mimetype='application/rss+xml')
+
+    def stream_feed(self, key, host_url, items):
+        """Stream the feed while it is rendered and cache it under key once complete"""
+        chunks = []
+        try:
+            for chunk in _render_rss(host_url, items):
+                chunks.append(chunk)
+                yield chunk
+        except Exception as e:
+            # Headers are already sent at this point, so the feed can only be cut short
+            logger.error(f"Error streaming RSS feed: {str(e)}", exc_info=True)
+            return
+        self._cache = (key, b"".join(chunks))
 
     def run(self):
 
@@ -159,7 +320,8 @@ class RSSFeed:
             except Exception:
                 port = 8001
             logger.info(f"Starting RSS feed server on port {port}")
-            self.app.run(host='0.0.0.0', port=port)
+            # waitress serves concurrent aggregator polls from a thread pool instead of the dev server
+            serve(self.app, host='0.0.0.0', port=port, threads=8)
         except Exception as e:
             logger.error(f"Error starting RSS feed server: {str(e)}", exc_info=True)
 